@@ -2,15 +2,22 @@
 This parser uses lark to transform the condition strings from signatures into callbacks that
 invoke the right sequence of searches into the rule and logic operations.
 """
-from typing import Any, Callable, Dict, Union
-
+import hashlib
+import os
+import sys
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+import lark
 from lark import Lark, Transformer
+from lark.exceptions import VisitError
 
 from .build_alert import Alert, callback_buildReport, check_timeframe
 from .exceptions import UnsupportedFeature
 from .sigma_configuration import PRODUCT_CATEGORY_MAPPING
-from .sigma_scan import analyze_x_of, match_search_id
-from .windows_event_logs import prepare_event_log
+from .sigma_scan import analyze_x_of, find_matches, match_search_id, match_x_of, select_matches
+from .windows_event_logs import EventBatch, prepare_event_log
 
 # Grammar defined for the condition strings within the Sigma rules
 grammar = '''
@@ -51,29 +58,87 @@ grammar = '''
         '''
 
 
-def check_event(raw_event, rules):
+def check_event(raw_event, rules: Union['RuleIndex', Dict[str, Any], Iterable[Any]]):
+    """
+    Check a single event against signatures.
+
+    :param raw_event: event as loaded from the log
+    :param rules: a RuleIndex, a mapping of ids to signatures (like PySigma.rules), or just the signatures.
+                  Pass a RuleIndex when checking many events against the same signatures.
+    :return: list of alerts for the signatures that hit
+    """
     event = prepare_event_log(raw_event)
     alerts = []
     timed_events = []
 
-    rules = _get_relevant_rules(event, rules)
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules.values() if isinstance(rules, dict) else rules)
 
-    for rule_id, rule_obj in rules.items():
-        condition = rule_obj.get_condition()
-        rule_name = rule_obj.title
+    for rule_obj in rules.get_relevant_rules(event):
+        condition = rule_obj.get_condition_function()
         if condition(rule_obj, event):
-            timeframe = rule_obj.get_timeframe()
-            if timeframe is not None:
-                check_timeframe(rule_obj, rule_name, timed_events, event, alerts)
-            else:
-                alert = Alert(rule_name, rule_obj.description, event, rule_obj.level,
-                              rule_obj.id, rule_obj.file_name, rule_obj.signature_source)
-                callback_buildReport(alerts, alert)
+            _report_hit(rule_obj, event, alerts, timed_events)
     return alerts
 
 
-def get_category(event):
-    channel = event.get("Channel").lower()
+def check_events_batch(raw_events, rules: Union['RuleIndex', Dict[str, Any], Iterable[Any]]) -> List[list]:
+    """
+    Check many events against signatures, one signature at a time across all the events
+    it is relevant to, rather than one event at a time.
+
+    :param raw_events: events as loaded from the log
+    :param rules: signatures, as accepted by check_event
+    :return: list with the alerts of each event, the same as calling check_event on each
+    """
+    batch = EventBatch([prepare_event_log(_e) for _e in raw_events])
+    events = batch.events
+    event_alerts = [[] for _ in events]
+
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules.values() if isinstance(rules, dict) else rules)
+
+    # Events with the same channel and category share the same relevant signatures
+    groups: Dict[int, Tuple[Tuple[Any, ...], List[int]]] = {}
+    for position, event in enumerate(events):
+        relevant = rules.get_relevant_rules(event)
+        groups.setdefault(id(relevant), (relevant, []))[1].append(position)
+
+    for relevant, positions in groups.values():
+        for rule_obj in relevant:
+            condition = compile_batch_condition(rule_obj.get_condition())
+            # Signatures are visited in order, so each event gets its alerts in the same order as check_event
+            for position in condition(rule_obj, batch, positions):
+                _report_hit(rule_obj, events[position], event_alerts[position], [])
+    return event_alerts
+
+
+def _report_hit(rule_obj, event, alerts: list, timed_events):
+    rule_name = rule_obj.title
+    timeframe = rule_obj.get_timeframe()
+    if timeframe is not None:
+        check_timeframe(rule_obj, rule_name, timed_events, event, alerts)
+    else:
+        alert = Alert(rule_name, rule_obj.description, event, rule_obj.level,
+                      rule_obj.id, rule_obj.file_name, rule_obj.signature_source)
+        callback_buildReport(alerts, alert)
+
+
+def get_event_channel(event) -> str:
+    """
+    The event's channel in lowercase, read from the prepared event's lowered fields
+    when they are available
+    :param event: The event, its channel is where the EVTX event was generated
+    :return: The lowered channel
+    """
+    lower_fields = getattr(event, 'lower_fields', None)
+    if lower_fields is not None:
+        return lower_fields["Channel"]
+    return event.get("Channel").lower()
+
+
+def get_category(event, channel: Optional[str] = None):
+    if channel is None:
+        channel = get_event_channel(event)
     for product, category_spec in PRODUCT_CATEGORY_MAPPING.items():
         if product in channel:
             for category, conditions in category_spec.items():
@@ -95,34 +160,56 @@ def get_category(event):
                     return category
     return None
 
-def _get_relevant_rules(event: dict, rules: Dict[str, Any]) -> Dict[str, Any]:
+LogsourceKey = Tuple[Optional[str], Optional[str], Optional[str]]
+
+
+def _get_logsource_key(signature) -> LogsourceKey:
+    logsource = signature.get_logsource()
+    return (logsource.get("product"), logsource.get("service"), logsource.get("category"))
+
+
+def _logsource_matches(key: LogsourceKey, channel: str, event_category: Optional[str]) -> bool:
+    product, service, category = key
+    if event_category and not event_category.startswith(str(category)):
+        return False
+    return not any(element.lower() not in channel for element in (product, service) if element)
+
+
+class RuleIndex:
     """
-    This method grabs a subset of the Sigma rules that are relevant to the event
-    https://github.com/SigmaHQ/sigma/wiki/Specification#log-source
-    :param channel: The channel in which the EVTX event was generated
-    :param rules: All Sigma rules
-    :return: A subset of relevant Sigma rules for the channel
+    Signatures grouped by log source. The signatures relevant to an event only depend
+    on the event's channel and category, so the relevant subset is worked out once per
+    distinct pair and reused for later events.
     """
-    if not event.get("Channel"):
-        return rules
-
-    channel = event.get("Channel").lower()
-    event_category = get_category(event)
-
-    relevant_rules: Dict[str, Any] = {}
-    for id, signature in rules.items():
-        logsource = signature.get_logsource()
-        prefilter_items = [logsource.get("product"),
-                           logsource.get("service"),
-                           ]
-        if event_category and not event_category.startswith(str(logsource.get('category'))):
-            continue
-        if any(element.lower() not in channel for element in prefilter_items if element):
-            continue
 
-        relevant_rules[id] = signature
-
-    return relevant_rules
+    def __init__(self, rules: Iterable[Any]):
+        self.rules = tuple(rules)
+        self._keys = tuple(_get_logsource_key(_r) for _r in self.rules)
+        self._by_logsource: Dict[LogsourceKey, List[Any]] = {}
+        for key, signature in zip(self._keys, self.rules):
+            self._by_logsource.setdefault(key, []).append(signature)
+        self._relevant: Dict[Tuple[str, Optional[str]], Tuple[Any, ...]] = {}
+
+    def get_relevant_rules(self, event: dict) -> Tuple[Any, ...]:
+        """
+        This method grabs a subset of the Sigma rules that are relevant to the event
+        https://github.com/SigmaHQ/sigma/wiki/Specification#log-source
+        :param event: The prepared event, its channel is where the EVTX event was generated
+        :return: A subset of relevant Sigma rules for the event
+        """
+        if not event.get("Channel"):
+            return self.rules
+
+        channel = get_event_channel(event)
+        event_category = get_category(event, channel)
+        bucket_key = (channel, event_category)
+        relevant = self._relevant.get(bucket_key)
+        if relevant is None:
+            # Test each distinct log source once, but keep the signatures in their original order
+            matches = {key: _logsource_matches(key, channel, event_category) for key in self._by_logsource}
+            relevant = tuple(_r for key, _r in zip(self._keys, self.rules) if matches[key])
+            self._relevant[bucket_key] = relevant
+        return relevant
 
 #
 # def parse_logfiles(*logfiles):
@@ -166,19 +253,46 @@ def false_function(*_state):
     return False
 
 
+# Opcodes of the flattened condition programs built by FactoryTransformer. A program is a
+# tuple of (opcode, *arguments) tuples, read as running on a value stack.
+#   MATCH search_id        push the result of the named search
+#   XOF count selector     push the result of an "x of" statement
+#   NOT                    negate the top of the stack
+#   AND skip / OR skip     short circuit: when the top of the stack already decides the
+#                          operation leave it and jump over the next `skip` ops,
+#                          otherwise pop it and evaluate the right hand side
+OP_MATCH = 'MATCH'
+OP_XOF = 'XOF'
+OP_NOT = 'NOT'
+OP_AND = 'AND'
+OP_OR = 'OR'
+
+Ops = Tuple[tuple, ...]
+
+
+def _chain(operation: str, args: List[Ops]) -> Ops:
+    """
+    Join the programs in args with a short circuiting operation. The chain is built from
+    the right so that every jump lands on the end of the whole expression.
+    """
+    ops = args[-1]
+    for component in reversed(args[:-1]):
+        ops = component + ((operation, len(ops)),) + ops
+    return ops
+
+
 class FactoryTransformer(Transformer):
+    """
+    Builds condition programs from the parse tree. The grammar guarantees that every
+    child handed to the rule methods below is already a program, so they don't check.
+    """
     @staticmethod
     def start(args):
         return args[0]
 
     @staticmethod
     def search_id(args):
-        name = args[0].value
-
-        def match_hits(signature, event):
-            return match_search_id(signature, event, name)
-
-        return match_hits
+        return ((OP_MATCH, args[0].value),)
 
     @staticmethod
     def search_pattern(args):
@@ -186,52 +300,26 @@ class FactoryTransformer(Transformer):
 
     @staticmethod
     def atom(args):
-        if not all((callable(_x) for _x in args)):
-            raise ValueError(args)
         return args[0]
 
     @staticmethod
     def not_rule(args):
         negate, value = args
-        assert callable(value)
         if negate is None:
             return value
-
-        def _negate(*state):
-            return not value(*state)
-        return _negate
+        return value + ((OP_NOT,),)
 
     @staticmethod
     def and_rule(args):
-        if not all((callable(_x) for _x in args)):
-            raise ValueError(args)
-
         if len(args) == 1:
             return args[0]
-
-        def _and_operation(*state):
-            for component in args:
-                if not component(*state):
-                    return False
-            return True
-
-        return _and_operation
+        return _chain(OP_AND, args)
 
     @staticmethod
     def or_rule(args):
-        if not all((callable(_x) for _x in args)):
-            raise ValueError(args)
-
         if len(args) == 1:
             return args[0]
-
-        def _or_operation(*state):
-            for component in args:
-                if component(*state):
-                    return True
-            return False
-
-        return _or_operation
+        return _chain(OP_OR, args)
 
     @staticmethod
     def pipe_rule(args):
@@ -249,10 +337,7 @@ class FactoryTransformer(Transformer):
         if selector == "them":
             selector = None
 
-        # Create a closure on our
-        def _check_of_sections(signature, event):
-            return analyze_x_of(signature, event, count, selector)
-        return _check_of_sections
+        return ((OP_XOF, count, selector),)
 
     @staticmethod
     def aggregation_expression(args):
@@ -263,11 +348,266 @@ class FactoryTransformer(Transformer):
         raise UnsupportedFeature("Near operation not supported.")
 
 
-# Create & initialize Lark class instance
-factory_parser = Lark(grammar, parser='lalr', transformer=FactoryTransformer(), maybe_placeholders=True)
+def _fold_ops(ops: Ops, leaf: Callable, negate: Callable, combine: Callable):
+    """
+    Rebuild the expression tree of a condition program bottom up.
+
+    :param ops: condition program
+    :param leaf: called with each MATCH or XOF op
+    :param negate: called with the folded operand of a NOT op
+    :param combine: called with the operation and the folded left and right operands
+                    of each AND or OR op
+    :return: the folded value of the whole program
+    """
+    stack = []
+    index = 0
+    end = len(ops)
+    while index < end:
+        op = ops[index]
+        code = op[0]
+        if code == OP_NOT:
+            stack.append(negate(stack.pop()))
+        elif code == OP_AND or code == OP_OR:
+            # The right hand side is exactly the ops jumped over by the short circuit
+            right_end = index + 1 + op[1]
+            right = _fold_ops(ops[index + 1:right_end], leaf, negate, combine)
+            stack.append(combine(code, stack.pop(), right))
+            index = right_end
+            continue
+        else:
+            stack.append(leaf(op))
+        index += 1
+    return stack[-1]
+
+
+class _CostNode(NamedTuple):
+    cost: float
+    ops: Ops
+    operation: Optional[str] = None
+    operands: Tuple['_CostNode', ...] = ()
+
+
+def reorder_condition(ops: Ops, cost: Callable[[tuple], float]) -> Ops:
+    """
+    Reorder the operands of and/or chains so the cheapest checks run first, and the
+    expensive checks are the ones most often skipped by the short circuit. Searches
+    have no side effects so the operand order doesn't change the result.
+
+    :param ops: condition program
+    :param cost: estimated cost of evaluating a MATCH or XOF op
+    :return: equivalent condition program
+    """
+    def leaf(op):
+        return _CostNode(cost(op), (op,))
+
+    def negate(node):
+        return _CostNode(node.cost, node.ops + ((OP_NOT,),))
+
+    def combine(operation, left, right):
+        operands = []
+        for node in (left, right):
+            if node.operation == operation:
+                operands.extend(node.operands)
+            else:
+                operands.append(node)
+        operands.sort(key=lambda _x: _x.cost)
+        return _CostNode(sum(_x.cost for _x in operands),
+                         _chain(operation, [_x.ops for _x in operands]),
+                         operation, tuple(operands))
+
+    return _fold_ops(ops, leaf, negate, combine).ops
+
+
+def _condition_expression(ops: Ops, match: Callable[[str], str], x_of: Callable[[Optional[int], Optional[str]], str]) -> str:
+    """
+    Fold a condition program back into the source of an equivalent Python expression.
+
+    :param match: gives the source evaluating the search with the given id
+    :param x_of: gives the source evaluating an x of statement with the given count and selector
+    """
+    # Folded values are (operation, source) pairs, so that operands of the same and/or
+    # chain can be joined without nesting parentheses
+    def leaf(op):
+        if op[0] == OP_MATCH:
+            return None, match(op[1])
+        return None, x_of(op[1], op[2])
+
+    def render(node):
+        return node[1] if node[0] is None else f'({node[1]})'
+
+    def negate(node):
+        return None, f'not {render(node)}'
+
+    def combine(operation, left, right):
+        parts = [node[1] if node[0] == operation else render(node) for node in (left, right)]
+        return operation, f' {operation.lower()} '.join(parts)
+
+    return render(_fold_ops(ops, leaf, negate, combine))
+
+
+def _exec_function(source: str, name: str) -> Callable:
+    namespace = {'match_search_id': match_search_id, 'analyze_x_of': analyze_x_of,
+                 'find_matches': find_matches, 'match_x_of': match_x_of}
+    exec(compile(source, '<sigma condition>', 'exec'), namespace)
+    return namespace[name]
+
+
+@lru_cache(maxsize=None)
+def compile_condition_factory(ops: Ops, search_ids: Tuple[str, ...]) -> Tuple[Callable, Tuple[Optional[str], ...]]:
+    """
+    Turn a condition program into a Python function, so the interpreter's own short
+    circuiting bytecode evaluates the condition. The search ids of the signature are
+    resolved to positions when compiling, so the condition doesn't look searches up by name.
+
+    The result is a factory taking the signature's searches (in search_ids order) and a tuple
+    with the searches covered by each of the returned x of selectors, which returns the
+    condition function for that signature. Signatures with the same condition and search
+    ids share a factory.
+
+    :param ops: condition program
+    :param search_ids: the search ids of the signature, in order
+    :return: factory, and the selectors its second argument is expected to resolve
+    """
+    selectors: List[Optional[str]] = []
+    used_searches = set()
+
+    def match(name):
+        if name not in search_ids:
+            # Raises when evaluated, like any other missing search
+            return f'match_search_id(signature, event, {name!r})'
+        index = search_ids.index(name)
+        used_searches.add(index)
+        return f'find_matches(event, search_{index})'
+
+    def x_of(count, selector):
+        if selector not in selectors:
+            selectors.append(selector)
+        return f'match_x_of(event, {count!r}, x_of_{selectors.index(selector)})'
+
+    expression = _condition_expression(ops, match, x_of)
+    bindings = [f'    search_{_i} = searches[{_i}]\n' for _i in sorted(used_searches)]
+    bindings += [f'    x_of_{_i} = x_of_searches[{_i}]\n' for _i in range(len(selectors))]
+    source = (
+        'def _make_condition(searches, x_of_searches):\n'
+        + ''.join(bindings) +
+        '    def _condition(signature, event):\n'
+        f'        return bool({expression})\n'
+        '    return _condition\n'
+    )
+    return _exec_function(source, '_make_condition'), tuple(selectors)
+
+
+@lru_cache(maxsize=None)
+def compile_batch_condition(ops: Ops) -> Callable:
+    """
+    Turn a condition program into a function taking (signature, batch, positions) that
+    returns the positions of the events in the EventBatch satisfying the condition. Each
+    operand is applied to a whole list of events at once, and the short circuit becomes
+    narrowing the list: the right side of an and only sees the events the left side kept,
+    the right side of an or only the ones it rejected.
+
+    :param ops: condition program
+    :return: function selecting the matching events
+    """
+    def leaf(op):
+        if op[0] == OP_MATCH:
+            name = op[1]
+
+            def _select_matches(signature, batch, positions):
+                search = signature.get_search_fields(name)
+                if not search:
+                    raise ValueError()
+                return select_matches(batch, search, positions)
+            return _select_matches
+
+        count, selector = op[1], op[2]
+
+        def _select_x_of(signature, batch, positions):
+            events = batch.events
+            return [_p for _p in positions if analyze_x_of(signature, events[_p], count, selector)]
+        return _select_x_of
+
+    def negate(value):
+        def _select_negation(signature, batch, positions):
+            hits = set(value(signature, batch, positions))
+            return [_p for _p in positions if _p not in hits]
+        return _select_negation
+
+    def combine(operation, left, right):
+        if operation == OP_AND:
+            def _select_and(signature, batch, positions):
+                positions = left(signature, batch, positions)
+                return right(signature, batch, positions) if positions else positions
+            return _select_and
+
+        def _select_or(signature, batch, positions):
+            hits = left(signature, batch, positions)
+            if len(hits) == len(positions):
+                return hits
+            found = set(hits)
+            return hits + right(signature, batch, [_p for _p in positions if _p not in found])
+        return _select_or
+
+    return _fold_ops(ops, leaf, negate, combine)
+
+
+def _grammar_cache_path() -> Union[str, bool]:
+    """
+    Where Lark keeps the LALR tables of the grammar. Lark unpickles the cache file when
+    building the parser, so it has to live in a directory only the current user can write
+    to, not Lark's default predictable name in the shared temp directory. The file name
+    includes what Lark checks the cache against (the grammar, Lark and Python versions), so
+    interpreters sharing the directory each keep their own cache.
+    :return: the cache file path, or False to not cache when there's no such directory
+    """
+    if not hasattr(os, 'getuid'):
+        # No owner to check the directory against
+        return False
+    try:
+        cache_dir = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'pysigma'
+        cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        status = cache_dir.stat()
+    except (OSError, RuntimeError):
+        return False
+    if status.st_uid != os.getuid() or status.st_mode & 0o077:
+        return False
+    digest = hashlib.sha256(grammar.encode()).hexdigest()[:16]
+    python_version = '.'.join(map(str, sys.version_info[:2]))
+    return str(cache_dir / f'condition_grammar_{digest}_lark{lark.__version__}_py{python_version}.lark')
+
+
+@lru_cache(maxsize=None)
+def get_factory_parser() -> Lark:
+    """
+    The Lark parser for condition strings, built when the first condition is parsed rather
+    than on import. The LALR tables are cached on disk so later processes skip the grammar
+    analysis. The parser only builds trees, the transformer is applied separately so a
+    single parser object can be shared between threads.
+    """
+    return Lark(grammar, parser='lalr', maybe_placeholders=True, cache=_grammar_cache_path())
+
+
+@lru_cache(maxsize=None)
+def _parse_condition(raw_condition: str) -> Ops:
+    """
+    Parse a condition string into its program. Programs only refer to search ids by
+    name, not to the signature, so one parse can be shared by every rule using the
+    same condition string. Each call transforms with its own FactoryTransformer, so
+    conditions can be parsed from several threads at once.
+    """
+    tree = get_factory_parser().parse(raw_condition)
+    try:
+        return FactoryTransformer().transform(tree)
+    except VisitError as error:
+        # Surface errors raised by the transformer (e.g. UnsupportedFeature) as-is
+        raise error.orig_exc from error
 
 
-def prepare_condition(raw_condition: Union[str, list]) -> Callable:
+def prepare_condition(raw_condition: Union[str, list]) -> Ops:
     if isinstance(raw_condition, list):
-        raw_condition = '(' + ') or ('.join(raw_condition) + ')'
-    return factory_parser.parse(raw_condition)
+        if not raw_condition:
+            raise ValueError(f"Empty condition list: {raw_condition!r}")
+        # A list of conditions is satisfied by any of them, parse each on its own and
+        # join the programs the same way an or_rule would.
+        return _chain(OP_OR, [_parse_condition(_c) for _c in raw_condition])
+    return _parse_condition(raw_condition)
@@ -1,12 +1,14 @@
 import argparse
 import copy
+import functools
 import json
 import logging
 import os
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, IO, Union, Dict
+from typing import Iterable, List, IO, Optional, Union, Dict
 from yaml.composer import ComposerError
 
 from . import signatures
@@ -18,6 +20,9 @@ from .windows_event_logs import load_events
 logger = logging.getLogger('pysigma')
 logger.setLevel(logging.INFO)
 
+# Number of signature files sent to a worker process at a time by PySigma.add_signatures
+LOAD_CHUNK_SIZE = 32
+
 
 def val_file(filename):
     ps = PySigma()
@@ -36,23 +41,72 @@ def val_file(filename):
 
 
 class PySigma:
-    def __init__(self, rule_files = [], callback = None):
+    def __init__(self, rule_files = [], callback = None, cache_rules = False):
         self.rules = {}
         self.callback = callback or self.default_callback
         self.hits = {}
+        self.cache_rules = cache_rules
+        # Index of self.rules used by check_events, rebuilt whenever self.rules changes
+        self._rule_index: Optional[parser.RuleIndex] = None
 
         for rule in rule_files:
-            self.add_signature(open(rule, 'r').read())
+            self.add_signature_path(rule)
 
     def add_signature(self, signature_file: Union[IO, str]):
         signature = signatures.load_signature(signature_file)
+        self._add_loaded_signature(signature)
+
+    def add_signature_path(self, signature_path: Union[str, Path]):
+        signature = signatures.load_signature_path(signature_path, use_cache=self.cache_rules)
+        self._add_loaded_signature(signature)
+
+    def add_signatures(self, signature_paths: Iterable[Union[str, Path]], max_workers: Optional[int] = None):
+        """
+        Load many signature files, parsing them in worker processes.
+
+        :param signature_paths: paths of the signature files to load
+        :param max_workers: number of worker processes, defaults to the number of CPUs
+        """
+        load = functools.partial(signatures.load_signature_path, use_cache=self.cache_rules)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # Signatures are added in the order of their paths, like repeated add_signature_path calls
+            for signature in executor.map(load, signature_paths, chunksize=LOAD_CHUNK_SIZE):
+                self._add_loaded_signature(signature)
+
+    def _add_loaded_signature(self, signature: signatures.Signature):
         self.rules[signature.id] = signature
-        parser.rules = self.rules
+        self._rule_index = None
+
+    def _get_rule_index(self) -> parser.RuleIndex:
+        index = self._rule_index
+        # self.rules is public and may be edited directly, so compare it with the indexed rules
+        # on every call rather than relying on the add methods to reset the index
+        if (index is None or len(index.rules) != len(self.rules)
+                or any(_a is not _b for _a, _b in zip(index.rules, self.rules.values()))):
+            index = self._rule_index = parser.RuleIndex(self.rules.values())
+        return index
 
     def check_events(self, events):
         all_alerts = []
+        rules = self._get_rule_index()
         for event in events:
-            alerts = parser.check_event(event, rules=self.rules)
+            alerts = parser.check_event(event, rules=rules)
+            if self.callback:
+                for a in alerts:
+                    self.callback(a, event)
+            all_alerts.extend(alerts)
+        return all_alerts
+
+    def check_events_batch(self, events):
+        """
+        Same as check_events, but evaluates each signature against all the events at once,
+        scanning each field column by column across the events. The alerts are the same as
+        check_events gives, in the same order.
+        """
+        events = list(events)
+        all_alerts = []
+        event_alerts = parser.check_events_batch(events, rules=self._get_rule_index())
+        for event, alerts in zip(events, event_alerts):
             if self.callback:
                 for a in alerts:
                     self.callback(a, event)
@@ -97,6 +151,10 @@ arg_parser = argparse.ArgumentParser(description='Sigma Checker - used to test r
 arg_parser.add_argument('paths', nargs='+', type=str, default=[],
                     help='A list of files or folders to be analyzed.')
 arg_parser.add_argument('-r', '--rules-dir', dest='rules_dir')
+arg_parser.add_argument('-c', '--cache-rules', action='store_true', default=False, dest='cache_rules',
+                    help='Store a JSON copy of each rule next to it to speed up loading the rules next time.')
+arg_parser.add_argument('-w', '--max-workers', type=int, default=None, dest='max_workers',
+                    help='Number of worker processes loading large rule directories, defaults to the number of CPUs.')
 
 
 def parse_args(custom_args=None):
@@ -107,9 +165,17 @@ def parse_args(custom_args=None):
 
     return options
 
-def check_with_rules(sample_list: List[str], rules_dir: str):
+def check_with_rules(sample_list: List[str], rules_dir: str, cache_rules: bool = False,
+                     max_workers: Optional[int] = None):
     # Instantiate class instance
-    sigma_checker = PySigma(rule_files=get_sigma_paths_from_dir(Path(rules_dir), recursive=True))
+    sigma_checker = PySigma(cache_rules=cache_rules)
+    rule_paths = list(get_sigma_paths_from_dir(Path(rules_dir), recursive=True))
+    if len(rule_paths) > LOAD_CHUNK_SIZE:
+        # Starting worker processes only pays off past a chunk of rules
+        sigma_checker.add_signatures(rule_paths, max_workers=max_workers)
+    else:
+        for rule_path in rule_paths:
+            sigma_checker.add_signature_path(rule_path)
 
     # Check imported rules against file(s)
     scoreboard = defaultdict(dict)
@@ -136,7 +202,7 @@ def main():
         else:
             samples.append(path)
 
-    scoreboard = check_with_rules(samples, options.rules_dir)
+    scoreboard = check_with_rules(samples, options.rules_dir, options.cache_rules, options.max_workers)
     print(json.dumps(scoreboard, indent=4))
 
 
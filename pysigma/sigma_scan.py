@@ -1,10 +1,13 @@
 
-import fnmatch
+import abc
 import regex as re
-from typing import List, TYPE_CHECKING
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+from .windows_event_logs import MISSING_FIELD
 
 if TYPE_CHECKING:
     from pysigma.signatures import DetectionField, DetectionMap, Query
+    from pysigma.windows_event_logs import EventBatch, PreparedEvent
 
 
 def match_search_id(signature, event, search_id):
@@ -14,12 +17,12 @@ def match_search_id(signature, event, search_id):
     raise ValueError()
 
 
-def check_pair(event, key, value: 'Query') -> bool:
+def check_pair(event: 'PreparedEvent', key, value: 'Query') -> bool:
     """
     Checks to see if a given key and value from the rule are also in the event.
     Takes into consideration any value modifiers.
 
-    :param event: dict, a single event from the event log
+    :param event: PreparedEvent, a single event from the event log
     :param key: str, given dict key
     :param value: str, given key value
     :return: bool, whether or not the match exists in the event
@@ -33,14 +36,176 @@ def check_pair(event, key, value: 'Query') -> bool:
 
     if isinstance(value, re.Pattern):
         return bool(value.match(str(event[key])))
+    elif isinstance(value, LiteralQuery):
+        return value.matches(event[key], get_lower_field(event, key))
     else:
-        # Because by default sigma string matching is case insensitive, lower the event
-        # string before comparing it. The value string is already lowercase.
-        # TODO potential optimization by caching lowercased event fields
-        return str(event[key]).lower() == value
+        # Because by default sigma string matching is case insensitive, compare against the
+        # lowered event string. The value string is already lowercase.
+        return get_lower_field(event, key) == value
+
+
+def get_lower_field(event: 'PreparedEvent', key) -> str:
+    """
+    The lowered string of the event's value for key, as computed by PreparedEvent. Plain
+    mappings are still accepted, their value is lowered on the spot.
+    """
+    try:
+        return event.lower_fields[key]
+    except AttributeError:
+        return str(event[key]).lower()
+
+
+def is_plain_text(lower_field: str) -> bool:
+    """
+    Whether comparing the lowered event value with lowered ASCII strings gives the same result
+    as the case insensitive regexes (see LiteralQuery). Unicode case folding matches more than
+    str.lower does (`İ` against `i`, `ſ` against `s`...), and `.` and `$` treat newlines
+    specially, so that only holds for ASCII values on a single line. The only non-ASCII
+    character lowered to ASCII is the kelvin sign, which the regexes also fold to `k`.
+    """
+    return lower_field.isascii() and '\n' not in lower_field
+
+
+def _any_pattern(patterns: 'List[re.Pattern]') -> 'Optional[re.Pattern]':
+    """A single pattern matching where any of the patterns match, None without patterns"""
+    if len(patterns) == 1:
+        return patterns[0]
+    if patterns:
+        # Every value pattern is compiled case insensitive (see signatures.apply_modifiers)
+        return re.compile('|'.join(f'(?:{_p.pattern})' for _p in patterns), re.IGNORECASE)
+    return None
+
+
+class LiteralQuery(abc.ABC):
+    """
+    A lowered ASCII sigma string without wildcards, either matched exactly or under a
+    contains, startswith or endswith modifier. Plain event values (see is_plain_text) are
+    compared with the str methods, any other value is matched with the case insensitive
+    regex the string would otherwise be compiled to, which is only compiled when first needed.
+    """
+    __slots__ = ('needle', 'source', '_pattern')
+
+    def __init__(self, needle: str, source: str):
+        self.needle = needle
+        self.source = source
+        self._pattern = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.needle!r})'
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.needle == other.needle
+
+    def __hash__(self):
+        return hash((type(self), self.needle))
+
+    @property
+    def pattern(self) -> 're.Pattern':
+        if self._pattern is None:
+            self._pattern = re.compile(self.source, re.IGNORECASE)
+        return self._pattern
+
+    def matches(self, field, lower_field: str) -> bool:
+        """
+        :param field: the event's value
+        :param lower_field: the lowered string of the event's value
+        """
+        if is_plain_text(lower_field):
+            return self.matches_plain(lower_field)
+        return bool(self.pattern.match(str(field)))
+
+    @abc.abstractmethod
+    def matches_plain(self, lower_field: str) -> bool:
+        """Whether the lowered event value, known to be plain text, matches the needle"""
+
+
+class Equals(LiteralQuery):
+    __slots__ = ()
+
+    def matches_plain(self, lower_field: str) -> bool:
+        return lower_field == self.needle
+
+
+class Contains(LiteralQuery):
+    __slots__ = ()
+
+    def matches_plain(self, lower_field: str) -> bool:
+        return self.needle in lower_field
+
+
+class StartsWith(LiteralQuery):
+    __slots__ = ()
+
+    def matches_plain(self, lower_field: str) -> bool:
+        return lower_field.startswith(self.needle)
+
+
+class EndsWith(LiteralQuery):
+    __slots__ = ()
+
+    def matches_plain(self, lower_field: str) -> bool:
+        return lower_field.endswith(self.needle)
+
+
+class AnyOfValues:
+    """
+    The permitted values of a field when any one of them is enough, grouped so they are all
+    checked in one pass over the event value: set lookups for the plain strings and exact
+    literals, tuples of literal prefixes and suffixes for str.startswith/str.endswith (which
+    loop over a tuple in C), the literal substrings, and a single alternation of all the
+    patterns, so the event value is scanned by regex at most once rather than once per pattern.
+    """
 
+    def __init__(self, values: 'List[Query]'):
+        self.allow_null = None in values
+        self.literals = frozenset(_v for _v in values if isinstance(_v, str))
+        self.exact = frozenset(_v.needle for _v in values if isinstance(_v, Equals))
+        self.prefixes = tuple(_v.needle for _v in values if isinstance(_v, StartsWith))
+        self.suffixes = tuple(_v.needle for _v in values if isinstance(_v, EndsWith))
+        self.substrings = tuple(_v.needle for _v in values if isinstance(_v, Contains))
+        self.literal_queries = tuple(_v for _v in values if isinstance(_v, LiteralQuery))
+        self.patterns = [_v for _v in values if isinstance(_v, re.Pattern)]
+        self.pattern = _any_pattern(self.patterns)
+        self._fallback_pattern = None
+
+    @property
+    def fallback_pattern(self) -> 'Optional[re.Pattern]':
+        """Alternation of the patterns and the regexes of the literals, for values that aren't plain text"""
+        if self._fallback_pattern is None and self.literal_queries:
+            self._fallback_pattern = _any_pattern(self.patterns + [_q.pattern for _q in self.literal_queries])
+        return self._fallback_pattern or self.pattern
+
+    def check(self, event: 'PreparedEvent', key) -> bool:
+        """Equivalent to any(check_pair(event, key, value) for value in values)"""
+        if key not in event:
+            return self.allow_null
+        return self.check_value(event[key], get_lower_field(event, key))
+
+    def check_value(self, field, lower_field) -> bool:
+        """
+        :param field: the event's value for the field, or MISSING_FIELD
+        :param lower_field: the lowered string of the event's value for the field
+        """
+        if field is None or field is MISSING_FIELD:
+            if self.allow_null:
+                return True
+            if field is MISSING_FIELD:
+                return False
+        if lower_field in self.literals:
+            return True
+        if not is_plain_text(lower_field):
+            pattern = self.fallback_pattern
+        elif (lower_field in self.exact
+                or lower_field.startswith(self.prefixes)
+                or lower_field.endswith(self.suffixes)
+                or any(_n in lower_field for _n in self.substrings)):
+            return True
+        else:
+            pattern = self.pattern
+        return pattern is not None and bool(pattern.match(str(field)))
 
-def find_matches(event: dict, search: 'DetectionField', match_all: bool = False):
+
+def find_matches(event: 'PreparedEvent', search: 'DetectionField', match_all: bool = False):
     """
     Matches the items in the rule to the event. Iterates through the sections and if there's a list it iterates
     through that. Uses checkPair to see if the items in the list/dictionary match items in the event log.
@@ -51,8 +216,10 @@ def find_matches(event: dict, search: 'DetectionField', match_all: bool = False)
     :return: bool, whether or not we found a match
     """
     if search.list_search:
-        check = all if match_all else any
-        return check(
+        if not match_all:
+            keywords = search.any_keyword
+            return any(keywords.check(event, event_key) for event_key in event)
+        return all(
             any(check_pair(event, event_key, field) for event_key in event)
             for field in search.list_search
         )
@@ -64,7 +231,7 @@ def find_matches(event: dict, search: 'DetectionField', match_all: bool = False)
     return False
 
 
-def find_matches_by_map(event: dict, search: 'DetectionMap'):
+def find_matches_by_map(event: 'PreparedEvent', search: 'DetectionMap'):
     """
 
     :param event:
@@ -72,17 +239,19 @@ def find_matches_by_map(event: dict, search: 'DetectionMap'):
     :return:
     """
 
-    for field_name, (value, modifiers) in search:
-        if not find_matches_by_map_entry(event, field_name, value, modifiers):
+    for field_name, (value, modifiers, any_value) in search:
+        if not find_matches_by_map_entry(event, field_name, value, modifiers, any_value):
             return False
     return True
 
 
-def find_matches_by_map_entry(event: dict, field_name, field_values: 'List[Query]', modifiers: List[str]):
+def find_matches_by_map_entry(event: 'PreparedEvent', field_name, field_values: 'List[Query]', modifiers: List[str],
+                              any_value: 'Optional[AnyOfValues]' = None):
     """
     :param event: the event to search in
     :param field_name: A field in the event we want to search
     :param field_values: valid values or patterns for the field in question
+    :param any_value: the field_values grouped for matching any of them, None with the all modifier
     :return:
     """
 
@@ -92,6 +261,8 @@ def find_matches_by_map_entry(event: dict, field_name, field_values: 'List[Query
             if not check_pair(event, field_name, permitted_value):
                 return False
         return True
+    elif any_value is not None:
+        return any_value.check(event, field_name)
     else:
         for permitted_value in field_values:
             if check_pair(event, field_name, permitted_value):
@@ -99,6 +270,97 @@ def find_matches_by_map_entry(event: dict, field_name, field_values: 'List[Query
         return False
 
 
+def select_matches(batch: 'EventBatch', search: 'DetectionField', positions: List[int]) -> List[int]:
+    """
+    Column wise find_matches, for many events at once.
+
+    :param batch: the events being scanned
+    :param search: An object describing what sort of search to run
+    :param positions: positions in the batch of the events to check
+    :return: positions of the events matching the search
+    """
+    if search.list_search:
+        # These check every field of each event, there is no column to scan
+        events = batch.events
+        return [_p for _p in positions if find_matches(events[_p], search)]
+
+    hits = []
+    for field in search.map_search:
+        kept = positions
+        for field_name, (value, modifiers, any_value) in field:
+            if not kept:
+                break
+            kept = select_by_map_entry(batch, kept, field_name, value, modifiers, any_value)
+        if kept:
+            # Any of the maps is enough, so the next ones only need the events still missing
+            hits.extend(kept)
+            found = set(kept)
+            positions = [_p for _p in positions if _p not in found]
+            if not positions:
+                break
+    return hits
+
+
+def select_by_map_entry(batch: 'EventBatch', positions: List[int], field_name, field_values: 'List[Query]',
+                        modifiers: List[str], any_value: 'Optional[AnyOfValues]' = None) -> List[int]:
+    """
+    Column wise find_matches_by_map_entry, for many events at once.
+
+    :param batch: the events being scanned
+    :param positions: positions in the batch of the events to check
+    :param field_name: A field in the event we want to search
+    :param field_values: valid values or patterns for the field in question
+    :param any_value: the field_values grouped for matching any of them, None with the all modifier
+    :return: positions of the events where the field matches
+    """
+    column = batch.get_column(field_name)
+    lower_column = batch.get_lower_column(field_name)
+    if any_value is not None and 'all' not in modifiers:
+        check_value = any_value.check_value
+    else:
+        check = all if 'all' in modifiers else any
+
+        def check_value(field, lower_field):
+            return check(check_column_value(field, lower_field, _v) for _v in field_values)
+
+    # Columns repeat the same strings a lot (images, users, hashes...), so each distinct
+    # string is only checked once per scan
+    results = {}
+    kept = []
+    for _p in positions:
+        field = column[_p]
+        if type(field) is str:
+            matched = results.get(field)
+            if matched is None:
+                matched = results[field] = check_value(field, lower_column[_p])
+        else:
+            matched = check_value(field, lower_column[_p])
+        if matched:
+            kept.append(_p)
+    return kept
+
+
+def check_column_value(field, lower_field, value: 'Query') -> bool:
+    """
+    check_pair for a value taken from an EventBatch column.
+
+    :param field: the event's value for the field, or MISSING_FIELD
+    :param lower_field: the lowered string of the event's value for the field
+    :param value: the value or pattern from the rule
+    :return: bool, whether or not the value matches
+    """
+    if value is None:
+        return field is None or field is MISSING_FIELD
+    if field is MISSING_FIELD:
+        return False
+
+    if isinstance(value, re.Pattern):
+        return bool(value.match(str(field)))
+    if isinstance(value, LiteralQuery):
+        return value.matches(field, lower_field)
+    return lower_field == value
+
+
 # def find_all_matches(event, rule_dict):
 #     """
 #     Matches the items in the rule to the event. Iterates through the sections and if there's a list it iterates
@@ -185,17 +447,19 @@ def analyze_x_of(signature, event, count, selector):
     :return: bool, truth value of 'x of' condition
     """
 
-    # First we need to choose our set of fields based on our selector.
-    matches = {}
-    all_searches = signature.get_all_searches()
+    # First we need our set of fields, the signature resolves each selector only once.
+    return match_x_of(event, count, signature.get_x_of_searches(selector))
 
-    if selector is None:  # None indicates all.
-        matches = all_searches
-    else:
-        for search_id, search_fields in all_searches.items():
-            if fnmatch.fnmatch(search_id, selector):
-                matches[search_id] = search_fields
 
+def match_x_of(event, count, matches: 'Tuple[DetectionField, ...]'):
+    """
+    Analyzes the truth value of an 'x of' condition once its selector has been resolved.
+
+    :param event: event currently being scanned
+    :param count: left side of the x of statement, either 1 or None (for all)
+    :param matches: the searches selected by the right side of the x of statement
+    :return: bool, truth value of 'x of' condition
+    """
     match_all = False
     if count is None:
         match_all = True
@@ -205,7 +469,7 @@ def analyze_x_of(signature, event, count, selector):
     # Now that we have our searches to check, run them
     search_hits = 0
     search_misses = 0
-    for search_id, search_fields in matches.items():
+    for search_fields in matches:
         if find_matches(event, search_fields, match_all):
             search_hits += 1
         else:
@@ -1,20 +1,33 @@
+import fnmatch
+import json
 import os
+from pathlib import Path
 from typing import Dict, List, IO, Union, Any, Optional, Callable, Tuple
 import base64
 import regex as re
 
 import yaml
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from .exceptions import UnsupportedFeature
-from .parser import prepare_condition
+from .sigma_scan import AnyOfValues, Contains, EndsWith, Equals, LiteralQuery, StartsWith
+from .parser import OP_MATCH, OP_XOF, Ops, compile_condition_factory, prepare_condition, reorder_condition
 
 
 class SignatureLoadError(KeyError):
     pass
 
-class PatchedSafeLoader(yaml.SafeLoader):     
-    yaml_implicit_resolvers = yaml.SafeLoader.yaml_implicit_resolvers.copy()
-    
+# Use the libyaml backed loader when PyYAML was built with it, it parses several times faster
+_Loader = yaml.CSafeLoader if hasattr(yaml, 'CSafeLoader') else yaml.SafeLoader
+
+
+class PatchedSafeLoader(_Loader):
+    yaml_implicit_resolvers = _Loader.yaml_implicit_resolvers.copy()
+
     # Avoid auto-resolution to "tag:yaml.org,2002:value" when encountering '='
     yaml_implicit_resolvers.pop('=')
 
@@ -47,10 +60,11 @@ MODIFIER_FUNCTIONS = {
     'startswith': lambda x: f'^{x}.*',
 }
 
-Query = Optional[Union[str, re.Pattern]]
+Query = Optional[Union[str, LiteralQuery, re.Pattern]]
+# field name, (permitted values, modifiers, the values grouped for any-of matching or None with the all modifier)
 DetectionMap = List[Tuple[
     str,
-    Tuple[List[Query], List[str]]]
+    Tuple[List[Query], List[str], Optional[AnyOfValues]]]
 ]
 
 
@@ -111,22 +125,42 @@ def sigma_string_to_regex(original_value: str):
 
 
 def get_modified_value(value, modifiers) -> str:
-    if modifiers:
+    if any(_m != 'all' for _m in modifiers):
         for mod in modifiers:
             func = MODIFIER_FUNCTIONS.get(mod)
             value = func(value) if func else value
     else:
-        # If there are no modifiers, we assume exact match
+        # If there are no modifiers, we assume exact match. The all modifier only changes
+        # how a list of values is combined, not how each value matches.
         value = f'^{value}$'
     return value
 
 
+LITERAL_QUERIES = {
+    None: Equals,
+    'contains': Contains,
+    'startswith': StartsWith,
+    'endswith': EndsWith,
+}
+
+
 def apply_modifiers(value: str, modifiers: List[str]) -> Query:
     """
     Apply as many modifiers as we can during signature construction
     to speed up the matching stage as much as possible.
     """
 
+    # ASCII strings without any wildcard under at most one of the position modifiers are
+    # compared directly where the event value allows it (see LiteralQuery), sigma string
+    # matching is case-insensitive so they are lowercased. Empty strings keep the original
+    # handling below.
+    if value and value.isascii() and '*' not in value and '?' not in value:
+        position_modifiers = [_m for _m in modifiers if _m != 'all']
+        if len(position_modifiers) <= 1:
+            query = LITERAL_QUERIES.get(position_modifiers[0] if position_modifiers else None)
+            if query is not None:
+                return query(value.lower(), get_modified_value(sigma_string_to_regex(value), modifiers))
+
     # If there are wildcards, or we are using the regex modifier, compile the query
     # string to a regex pattern object
 
@@ -142,10 +176,39 @@ def apply_modifiers(value: str, modifiers: List[str]) -> Query:
     return value.lower()
 
 
+# Relative costs used to order the searches of a condition, cheapest first
+LITERAL_COST = 1
+PATTERN_COST = 4
+# A list search is checked against every field of the event
+LIST_SEARCH_FANOUT = 10
+
+
+def estimate_query_cost(value: Query) -> int:
+    return PATTERN_COST if isinstance(value, re.Pattern) else LITERAL_COST
+
+
+def estimate_any_of_cost(values: AnyOfValues) -> int:
+    return (LITERAL_COST if values.literals or values.exact or values.prefixes or values.suffixes else 0) \
+        + LITERAL_COST * len(values.substrings) \
+        + (PATTERN_COST if values.pattern is not None else 0)
+
+
 class DetectionField:
     def __init__(self, list_search=None, map_search=None):
         self.list_search: List[Query] = list_search
         self.map_search: List[DetectionMap] = map_search
+        self.any_keyword = AnyOfValues(list_search) if list_search else None
+
+    def estimate_cost(self) -> int:
+        """Rough upper bound on the work needed to check this search against an event."""
+        if self.list_search:
+            return LIST_SEARCH_FANOUT * estimate_any_of_cost(self.any_keyword)
+        return sum(
+            estimate_any_of_cost(any_value) if any_value is not None
+            else sum(estimate_query_cost(_v) for _v in values)
+            for field_map in self.map_search or []
+            for _, (values, _, any_value) in field_map
+        )
 
 
 def normalize_field_map(field: Dict[str, Any]) -> DetectionMap:
@@ -153,12 +216,12 @@ def normalize_field_map(field: Dict[str, Any]) -> DetectionMap:
     for raw_key, value in field.items():
         key, modifiers = process_field_name(raw_key)
         if value is None:
-            out.append((key, ([None], modifiers)))
+            values = [None]
         elif isinstance(value, list):
-            out.append((key, ([apply_modifiers(str(_v), modifiers) if _v is not None else None
-                        for _v in value], modifiers)))
+            values = [apply_modifiers(str(_v), modifiers) if _v is not None else None for _v in value]
         else:
-            out.append((key, ([apply_modifiers(str(value), modifiers)], modifiers)))
+            values = [apply_modifiers(str(value), modifiers)]
+        out.append((key, (values, modifiers, None if 'all' in modifiers else AnyOfValues(values))))
     return out
 
 
@@ -187,9 +250,59 @@ class Detection:
         self.timeframe = detection.pop('timeframe', None)
 
         self.condition = None
-        if 'condition' in detection:
-            self.condition = prepare_condition(detection.pop('condition'))
+        self._condition_function = None
+        self._x_of_searches: Dict[Optional[str], Tuple[DetectionField, ...]] = {}
+        has_condition = 'condition' in detection
+        raw_condition = detection.pop('condition', None)
         self.detection = normalize_detection(detection)
+        # Searches by position, the compiled condition refers to them that way
+        self.search_ids = tuple(self.detection)
+        self.searches = tuple(self.detection.values())
+        if has_condition:
+            self.set_condition(raw_condition)
+
+    def __getstate__(self):
+        # Compiled functions don't pickle, they are rebuilt from the program on first use
+        state = self.__dict__.copy()
+        state['_condition_function'] = None
+        return state
+
+    def set_condition(self, raw_condition: Union[str, list]):
+        condition = prepare_condition(raw_condition)
+        # A search id missing from the detection raises once the evaluation reaches it, moving
+        # operands around would change whether it is reached, so those conditions keep their order
+        if all(op[0] != OP_MATCH or op[1] in self.detection for op in condition):
+            condition = reorder_condition(condition, self.estimate_cost)
+        self.condition = condition
+        self._condition_function = None
+
+    def get_condition_function(self) -> Callable:
+        if self._condition_function is None:
+            factory, selectors = compile_condition_factory(self.condition, self.search_ids)
+            self._condition_function = factory(self.searches,
+                                               tuple(self.get_x_of_searches(_s) for _s in selectors))
+        return self._condition_function
+
+    def estimate_cost(self, op: tuple) -> int:
+        if op[0] == OP_MATCH:
+            return self.detection[op[1]].estimate_cost()
+        if op[0] == OP_XOF:
+            return sum(search.estimate_cost() for search in self.get_x_of_searches(op[2]))
+        raise ValueError(op)
+
+    def get_x_of_searches(self, selector: Optional[str]) -> Tuple[DetectionField, ...]:
+        """
+        Resolve the right side of an "x of" statement to the searches it covers,
+        once per selector.
+
+        :param selector: a search id pattern, or None (for them)
+        """
+        searches = self._x_of_searches.get(selector)
+        if searches is None:
+            searches = tuple(search for name, search in self.detection.items()
+                             if selector is None or fnmatch.fnmatch(name, selector))
+            self._x_of_searches[selector] = searches
+        return searches
 
 
 class Signature:
@@ -223,7 +336,7 @@ class Signature:
                 # is in the wrong place relative to the rest of the standard
                 # so catch that here I suppose
                 if self.detections[-1].condition is None and 'condition' in segment:
-                    self.detections[-1].condition = prepare_condition(segment['condition'])
+                    self.detections[-1].set_condition(segment['condition'])
 
         if self.title is None:
             raise SignatureLoadError('title')
@@ -234,15 +347,21 @@ class Signature:
         if len(self.detections) > 1:
             raise UnsupportedFeature('Multiple YAML documents unsupported (Multiple Detections)')
 
-    def get_condition(self) -> Callable:
+    def get_condition(self) -> Ops:
         return self.detections[0].condition
 
+    def get_condition_function(self) -> Callable:
+        return self.detections[0].get_condition_function()
+
     def get_all_searches(self) -> Dict[str, DetectionField]:
         return dict(self.detections[0].detection)
 
     def get_search_fields(self, search_id) -> DetectionField:
         return self.detections[0].detection.get(search_id)
 
+    def get_x_of_searches(self, selector: Optional[str]) -> Tuple[DetectionField, ...]:
+        return self.detections[0].get_x_of_searches(selector)
+
     def get_timeframe(self):
         return self.detections[0].timeframe
 
@@ -289,6 +408,62 @@ def load_signature(signature_file: Union[IO, str]) -> Signature:
     return Signature(list(yaml.load_all(signature_file, PatchedSafeLoader)), file_name=source)
 
 
+def _dump_documents(documents: List[Dict]) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(documents, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(documents, default=str).encode()
+
+
+def _load_documents(raw: bytes) -> List[Dict]:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def get_cache_path(signature_path: Union[str, Path]) -> Path:
+    signature_path = Path(signature_path)
+    return signature_path.with_name(signature_path.name + '.json')
+
+
+def load_signature_path(signature_path: Union[str, Path], use_cache: bool = False) -> Signature:
+    """
+    Load a single sigma signature from a path
+
+    When use_cache is set, the parsed YAML documents are also stored as JSON next to the
+    signature (see get_cache_path) and that copy is loaded instead of the YAML for as long
+    as it is newer than the signature file. With equal modification times (filesystems
+    with coarse timestamps) an edit could have happened after the copy was written, so
+    the YAML is read again.
+
+    :param signature_path: path to a file containing sigma yaml
+    :param use_cache: whether to read and write the JSON copy of the signature
+    :return: Signature object
+    """
+    if not use_cache:
+        with open(signature_path, 'r') as handle:
+            return load_signature(handle)
+
+    cache_path = get_cache_path(signature_path)
+    documents = None
+    try:
+        if cache_path.stat().st_mtime_ns > os.stat(signature_path).st_mtime_ns:
+            documents = _load_documents(cache_path.read_bytes())
+    except (OSError, ValueError):
+        # Missing, unreadable or corrupt cache, fall back to the YAML
+        documents = None
+
+    if documents is None:
+        with open(signature_path, 'r') as handle:
+            documents = list(yaml.load_all(handle, PatchedSafeLoader))
+        try:
+            # Written before building the signature, which consumes parts of the documents
+            cache_path.write_bytes(_dump_documents(documents))
+        except (OSError, TypeError):
+            pass
+
+    return Signature(documents, file_name=str(signature_path))
+
+
 # def escape_compatible(detect):
 #     r"""
 #     Looks through a yaml signature detection section and replaces all escape characters with just the characters to be
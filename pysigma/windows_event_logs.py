@@ -1,4 +1,5 @@
 from collections.abc import MutableMapping
+from typing import Dict, List
 from xml.parsers.expat import ExpatError
 from io import open
 from evtx import PyEvtxParser
@@ -105,13 +106,55 @@ def convert_event_data_to_key_value(event_dict):
     return event_dict
 
 
+class PreparedEvent(dict):
+    """
+    Flattened event, along with views of its fields that are computed once and then shared
+    by every signature checked against the event.
+    """
+
+    def __init__(self, fields):
+        super().__init__(fields)
+        # Sigma string matching is case insensitive, lower every value once up front
+        self.lower_fields = {key: str(value).lower() for key, value in self.items()}
+
+
+# Placeholder in EventBatch columns for events that don't have the field
+MISSING_FIELD = object()
+
+
+class EventBatch:
+    """
+    A list of prepared events, with their fields also laid out column by column (one list
+    per field, indexed like the events) for scans checking a field across many events.
+    Columns are only built for the fields that get scanned. Events that aren't a
+    PreparedEvent yet are wrapped in one.
+    """
+
+    def __init__(self, events: List[PreparedEvent]):
+        self.events = [_e if isinstance(_e, PreparedEvent) else PreparedEvent(_e) for _e in events]
+        self._columns: Dict[str, list] = {}
+        self._lower_columns: Dict[str, list] = {}
+
+    def get_column(self, field: str) -> list:
+        column = self._columns.get(field)
+        if column is None:
+            column = self._columns[field] = [_e.get(field, MISSING_FIELD) for _e in self.events]
+        return column
+
+    def get_lower_column(self, field: str) -> list:
+        column = self._lower_columns.get(field)
+        if column is None:
+            column = self._lower_columns[field] = [_e.lower_fields.get(field) for _e in self.events]
+        return column
+
+
 def prepare_event_log(event):
     """
     Prepares event log for use and info extraction. Flattens event log, and converts event
     to key value pair.
     :param event: single Sysmon event from log
-    :return: dict, event dict
+    :return: PreparedEvent, event dict
     """
 
     flat = flattened(event)
-    return convert_event_data_to_key_value(flat)
+    return PreparedEvent(convert_event_data_to_key_value(flat))
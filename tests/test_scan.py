@@ -1,6 +1,11 @@
 import base64
+import os
+import sys
 
-from pysigma import PySigma
+import lark
+import pytest
+
+from pysigma import PySigma, UnsupportedFeature
 from pysigma.signatures import sigma_string_to_regex
 
 event = {
@@ -262,3 +267,377 @@ def test_base64():
     assert len(sigma.check_events([{"a": base64.b64encode(b"foo").decode()}])) == 1
     assert len(sigma.check_events([{"a": base64.encodebytes(b"foo").decode()}])) == 1
     assert len(sigma.check_events([{"a": "foo"}])) == 0
+
+
+def test_shared_condition_parsed_once():
+    from pysigma.parser import _parse_condition
+    sigma = PySigma()
+    sigma.add_signature(base_signature + "    condition: true_cats_expected and not false_expected")
+    hits = _parse_condition.cache_info().hits
+    sigma.add_signature(base_signature.replace('sample signature', 'second signature') +
+                        "    condition: true_cats_expected and not false_expected")
+    assert _parse_condition.cache_info().hits == hits + 1
+    assert len(sigma.check_events([event])) == 1
+
+
+def test_conditions_parsed_from_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    from pysigma.parser import prepare_condition
+    conditions = [f'(sel{_i} or not filter{_i}) and 1 of a{_i}*' for _i in range(64)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        programs = list(executor.map(prepare_condition, conditions))
+    assert programs == [prepare_condition(_c) for _c in conditions]
+    assert programs[3] == (('MATCH', 'sel3'), ('OR', 2), ('MATCH', 'filter3'), ('NOT',),
+                           ('AND', 1), ('XOF', 1, 'a3*'))
+
+
+def test_grammar_cache_path(tmp_path, monkeypatch):
+    from pysigma.parser import _grammar_cache_path
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path))
+    path = _grammar_cache_path()
+    assert os.path.dirname(path) == str(tmp_path / 'pysigma')
+    assert (tmp_path / 'pysigma').stat().st_mode & 0o777 == 0o700
+    # Interpreters with different Python or Lark versions don't share the file
+    assert f'py{sys.version_info[0]}.{sys.version_info[1]}' in os.path.basename(path)
+    assert f'lark{lark.__version__}' in os.path.basename(path)
+    (tmp_path / 'pysigma').chmod(0o770)
+    assert _grammar_cache_path() is False
+
+
+def test_aggregation_unsupported():
+    sigma = PySigma()
+    with pytest.raises(UnsupportedFeature):
+        sigma.add_signature(base_signature + "    condition: true_expected | count() > 5")
+
+
+def test_condition_program():
+    from pysigma.parser import prepare_condition
+    assert prepare_condition('a and not b or c') == (
+        ('MATCH', 'a'), ('AND', 2), ('MATCH', 'b'), ('NOT',), ('OR', 1), ('MATCH', 'c'),
+    )
+    assert prepare_condition('1 of sel* and them') == (('XOF', 1, 'sel*'), ('AND', 1), ('MATCH', 'them'))
+
+
+def test_condition_reordered_by_cost():
+    sigma = PySigma()
+    sigma.add_signature("""
+        title: sample signature
+        detection:
+            keywords:
+                - "red*things"
+            selection:
+                cats: good
+            condition: (all of them or keywords) and selection
+    """)
+    rule = next(iter(sigma.rules.values()))
+    assert rule.get_condition() == (
+        ('MATCH', 'selection'), ('AND', 3), ('MATCH', 'keywords'), ('OR', 1), ('XOF', None, None),
+    )
+    assert len(sigma.check_events([{'cats': 'good', 'log': 'red and blue things', 'Data': []}])) == 1
+    assert len(sigma.check_events([{'cats': 'bad', 'log': 'red and blue things', 'Data': []}])) == 0
+
+
+def test_unknown_search_not_reordered():
+    first = PySigma()
+    first.add_signature(base_signature + "    condition: missing or true_expected")
+    rule = next(iter(first.rules.values()))
+    assert rule.get_condition() == (('MATCH', 'missing'), ('OR', 1), ('MATCH', 'true_expected'))
+    with pytest.raises(ValueError):
+        first.check_events([event])
+
+    last = PySigma()
+    last.add_signature(base_signature + "    condition: true_expected or missing")
+    rule = next(iter(last.rules.values()))
+    assert rule.get_condition() == (('MATCH', 'true_expected'), ('OR', 1), ('MATCH', 'missing'))
+    assert len(last.check_events([event])) == 1
+    with pytest.raises(ValueError):
+        last.check_events([{'Data': []}])
+
+
+def test_relevant_rules_by_logsource():
+    from pysigma.parser import RuleIndex
+    from pysigma.windows_event_logs import prepare_event_log
+    sigma = PySigma()
+    for product in ('acme', 'other'):
+        sigma.add_signature(f"""
+            title: {product} signature
+            id: {product}
+            logsource:
+                product: {product}
+            detection:
+                selection:
+                    cats: good
+                condition: selection
+        """)
+    index = RuleIndex(sigma.rules.values())
+    acme_event = {'Channel': 'ACME/Operational', 'cats': 'good'}
+    relevant = index.get_relevant_rules(acme_event)
+    assert [rule.id for rule in relevant] == ['acme']
+    assert index.get_relevant_rules(dict(acme_event)) is relevant
+    assert index.get_relevant_rules(prepare_event_log(acme_event)) is relevant
+    assert len(index.get_relevant_rules({'cats': 'good'})) == 2
+    assert [alert['id'] for alert in sigma.check_events([acme_event])] == ['acme']
+
+
+def test_rules_edited_directly():
+    sigma = PySigma()
+    sigma.add_signature(base_signature.replace('title: sample signature', 'title: first\nid: 1') +
+                        "    condition: true_expected")
+    sigma.add_signature(base_signature.replace('title: sample signature', 'title: second\nid: 2') +
+                        "    condition: true_cats_expected")
+    assert [alert['id'] for alert in sigma.check_events([event])] == [1, 2]
+    del sigma.rules[1]
+    assert [alert['id'] for alert in sigma.check_events([event])] == [2]
+    replaced = PySigma()
+    replaced.add_signature(base_signature.replace('title: sample signature', 'title: second\nid: 2') +
+                           "    condition: false_expected")
+    sigma.rules[2] = replaced.rules[2]
+    assert sigma.check_events([event]) == []
+    assert sigma.check_events_batch([event]) == []
+
+
+def test_condition_list():
+    from pysigma.parser import prepare_condition
+    assert prepare_condition(['a and b', 'c']) == prepare_condition('(a and b) or (c)')
+
+    sigma = PySigma()
+    sigma.add_signature(base_signature + """    condition:
+        - false_expected
+        - true_cats_expected and not false_also_expected
+        - true_expected
+""")
+    assert len(sigma.check_events([event])) == 1
+    sigma = PySigma()
+    sigma.add_signature(base_signature + """    condition:
+        - false_expected
+        - false_also_expected
+""")
+    assert len(sigma.check_events([event])) == 0
+
+
+def test_empty_condition_list():
+    sigma = PySigma()
+    with pytest.raises(ValueError, match='Empty condition list'):
+        sigma.add_signature(base_signature + "    condition: []")
+
+
+def eval_ops(ops, signature, event) -> bool:
+    """
+    Reference interpreter for condition programs, running the ops on a value stack as
+    documented in pysigma.parser, to check the compiled condition functions against.
+    """
+    from pysigma.parser import OP_AND, OP_MATCH, OP_NOT, OP_OR, OP_XOF
+    from pysigma.sigma_scan import analyze_x_of, match_search_id
+    stack = []
+    index = 0
+    while index < len(ops):
+        op = ops[index]
+        if op[0] == OP_MATCH:
+            stack.append(match_search_id(signature, event, op[1]))
+        elif op[0] == OP_XOF:
+            stack.append(analyze_x_of(signature, event, op[1], op[2]))
+        elif op[0] == OP_NOT:
+            stack[-1] = not stack[-1]
+        elif op[0] == OP_AND:
+            if stack[-1]:
+                stack.pop()
+            else:
+                index += op[1]
+        elif op[0] == OP_OR:
+            if stack[-1]:
+                index += op[1]
+            else:
+                stack.pop()
+        index += 1
+    return bool(stack[-1])
+
+
+def test_compiled_condition_matches_interpreter():
+    from pysigma.parser import compile_condition_factory, prepare_condition
+    from pysigma.windows_event_logs import prepare_event_log
+    sigma = PySigma()
+    sigma.add_signature(complicated_condition)
+    rule = next(iter(sigma.rules.values()))
+    prepared = prepare_event_log(event)
+    for condition in ['true_expected and not false_expected', 'not (false_expected or true_expected)',
+                      'not (not true_expected)', 'false_expected or false_also_expected and true_expected',
+                      '(false_expected or true_cats_expected) and (1 of false_* or all of true_*)']:
+        ops = prepare_condition(condition)
+        expected = eval_ops(ops, rule, prepared)
+
+        detection = rule.detections[0]
+        factory, selectors = compile_condition_factory(ops, detection.search_ids)
+        bound = factory(detection.searches, tuple(detection.get_x_of_searches(_s) for _s in selectors))
+        assert bound(rule, prepared) == expected
+
+
+def test_plain_dict_events():
+    from pysigma.parser import compile_batch_condition
+    from pysigma.sigma_scan import find_matches
+    from pysigma.windows_event_logs import EventBatch, prepare_event_log
+    sigma = PySigma()
+    sigma.add_signature(complicated_condition)
+    rule = next(iter(sigma.rules.values()))
+    plain = {'cats': 'Good', 'dogs': 'good', 'dog_count': 2, 'birds': 'many'}
+    condition = rule.get_condition_function()
+    assert condition(rule, plain) == condition(rule, prepare_event_log(plain)) is True
+    assert find_matches(plain, rule.get_search_fields('true_expected'))
+    assert not find_matches(plain, rule.get_search_fields('false_expected'))
+    assert compile_batch_condition(rule.get_condition())(rule, EventBatch([plain]), [0]) == [0]
+
+
+def test_batch_matches_single_events():
+    sigma = PySigma()
+    for index, condition in enumerate(['true_expected', 'true_cats_expected and not false_expected',
+                                       'false_expected or all of true_*', 'not 1 of false_*',
+                                       'false_expected']):
+        sigma.add_signature(base_signature.replace('title: sample signature', f'title: signature {index}\nid: {index}') +
+                            f"    condition: {condition}")
+    events = [event, {'cats': 'bad', 'Data': []}, {'dogs': 'ok', 'cats': 'Good', 'Data': []}, {'Data': []}]
+    assert sigma.check_events_batch(events) == sigma.check_events(events)
+    assert len(sigma.check_events(events)) == 9
+
+
+def test_batch_null_and_all_modifier():
+    sigma = PySigma()
+    sigma.add_signature("""
+        title: null signature
+        id: 1
+        detection:
+            forbid:
+                x: null
+            filter:
+                y: null
+            condition: forbid and not filter
+    """)
+    sigma.add_signature("""
+        title: all signature
+        id: 2
+        detection:
+            selection:
+                log|contains|all:
+                    - red
+                    - blue
+            condition: selection
+    """)
+    events = [{'y': 'found', 'Data': []}, {'z': 'found', 'Data': []}, {'y': 'found', 'x': 'also', 'Data': []},
+              {'y': 'red and blue', 'log': 'red and blue', 'Data': []}, {'log': 'red', 'Data': []}]
+    assert [alert['id'] for alert in sigma.check_events_batch(events)] == [1, 1, 2]
+    assert sigma.check_events_batch(events) == sigma.check_events(events)
+
+
+def test_batch_repeated_values():
+    sigma = PySigma()
+    sigma.add_signature("""
+        title: repeated signature
+        id: 1
+        detection:
+            selection:
+                log|contains|all:
+                    - red
+                    - blue
+                count: 2
+            condition: selection
+    """)
+    events = [{'log': log, 'count': count, 'Data': []}
+              for log in ('red and blue', 'Red and Blue', 'red') for count in (2, '2', 3, 2)]
+    assert [alert['id'] for alert in sigma.check_events_batch(events)] == [1] * 6
+    assert sigma.check_events_batch(events) == sigma.check_events(events)
+
+
+def test_any_of_values():
+    sigma = PySigma()
+    sigma.add_signature(r"""
+        title: sample signature
+        detection:
+            selection:
+                Image|endswith:
+                    - '\cmd.exe'
+                    - '\power*.exe'
+                    - null
+                User: 'SYSTEM'
+            condition: selection
+    """)
+    rule = next(iter(sigma.rules.values()))
+    _, (_, _, any_value) = rule.get_search_fields('selection').map_search[0][0]
+    assert any_value.allow_null and any_value.pattern is not None
+
+    def hits(**fields):
+        return len(sigma.check_events([dict(fields, Data=[])]))
+
+    assert hits(Image=r'C:\Windows\CMD.exe', User='system') == 1
+    assert hits(Image=r'C:\Windows\powershell.exe', User='SYSTEM') == 1
+    assert hits(User='SYSTEM') == 1
+    assert hits(Image=r'C:\Windows\notepad.exe', User='SYSTEM') == 0
+    assert hits(Image=r'C:\Windows\cmd.exe', User='admin') == 0
+
+
+def _literal_hits(field, values, events):
+    sigma = PySigma()
+    sigma.add_signature(f"""
+        title: literal signature
+        detection:
+            selection:
+                {field}: {values}
+            condition: selection
+    """)
+    events = [dict(_e, Data=[]) for _e in events]
+    assert sigma.check_events_batch(events) == sigma.check_events(events)
+    return [len(sigma.check_events([_e])) for _e in events]
+
+
+def test_literal_queries():
+    from pysigma.sigma_scan import Contains, EndsWith, Equals, LiteralQuery, StartsWith
+    from pysigma.signatures import apply_modifiers
+    for modifiers, query_type in [([], Equals), (['all'], Equals), (['contains'], Contains),
+                                  (['startswith'], StartsWith), (['endswith', 'all'], EndsWith)]:
+        query = apply_modifiers('Good', modifiers)
+        assert type(query) is query_type and query.needle == 'good'
+    for value, modifiers in [('Good', ['re']), ('Go*d', ['contains']), ('İyi', ['contains']),
+                             ('Good', ['contains', 'endswith'])]:
+        assert not isinstance(apply_modifiers(value, modifiers), (str, LiteralQuery))
+
+    events = [{'log': 'Good'}, {'log': 'very good dog'}, {'log': 'good dog'}, {'log': 'a good'},
+              {'log': 'good\n'}, {'log': 'a good\n'}, {'log': None}, {'other': 'good'}]
+    assert _literal_hits('log', "'good'", events) == [1, 0, 0, 0, 1, 0, 0, 0]
+    assert _literal_hits('log|contains', "'good'", events) == [1, 1, 1, 1, 1, 1, 0, 0]
+    assert _literal_hits('log|startswith', "'good'", events) == [1, 0, 1, 0, 1, 0, 0, 0]
+    assert _literal_hits('log|endswith', "'good'", events) == [1, 0, 0, 1, 1, 1, 0, 0]
+    # Several literals are grouped by AnyOfValues
+    assert _literal_hits('log|endswith', "['dog', 'good']", events) == [1, 1, 1, 1, 1, 1, 0, 0]
+    assert _literal_hits('log|startswith', "['a ', 'good']", events) == [1, 0, 1, 1, 1, 1, 0, 0]
+    assert _literal_hits('log|contains', "['dog', 'x']", events) == [0, 1, 1, 0, 0, 0, 0, 0]
+    assert _literal_hits('log', "['good', 'good dog']", events) == [1, 0, 1, 0, 1, 0, 0, 0]
+
+
+def test_empty_literal():
+    events = [{'log': ''}, {'log': 'good'}, {'log': None}, {'other': 'good'}]
+    for modifier in ('', '|contains', '|startswith', '|endswith'):
+        assert _literal_hits(f'log{modifier}', "''", events) == [0, 0, 0, 0]
+
+
+def test_backslash_literal():
+    events = [{'path': r'C:\Abc\Def'}, {'path': r'C:\abcdef'}, {'path': r'abc\d'}]
+    assert _literal_hits('path|contains', r"'abc\d'", events) == [1, 0, 1]
+    assert _literal_hits('path|endswith', r"'\def'", events) == [1, 0, 0]
+    assert _literal_hits('path', r"'abc\d'", events) == [0, 0, 1]
+
+
+def test_literal_unicode_case_folding():
+    # Literals are compared lowered only for plain ASCII event values, other values get the
+    # full case folding of the regexes
+    events = [{'v': 'İSTANBUL'}, {'v': 'istanbul'}, {'v': 'ADMİN'}, {'v': 'ſ.exe'}, {'v': 'S.EXE'}, {'v': 'ünïcode'}]
+    assert _literal_hits('v', "'istanbul'", events) == [1, 1, 0, 0, 0, 0]
+    assert _literal_hits('v|contains', "'admin'", events) == [0, 0, 1, 0, 0, 0]
+    assert _literal_hits('v|endswith', "'s.exe'", events) == [0, 0, 0, 1, 1, 0]
+    assert _literal_hits('v|startswith', "['ist', 's.']", events) == [1, 1, 0, 1, 1, 0]
+    assert _literal_hits('v|contains', "['co', 'dmi']", events) == [0, 0, 1, 0, 0, 1]
+
+
+def test_all_modifier_exact_match():
+    # Without a position modifier every value under all has to match the whole field, with
+    # or without wildcards
+    events = [{'v': 'fo'}, {'v': 'foobar'}, {'v': 'FO'}]
+    assert _literal_hits('v|all', "'fo'", events) == [1, 0, 1]
+    assert _literal_hits('v|all', "'f?'", events) == [1, 0, 1]
+    assert _literal_hits('v|all', "['f*', '*o']", events) == [1, 0, 1]
@@ -3,8 +3,9 @@ Find way to validate that events are hitting on the right rules
 """
 import os
 import os.path
+import shutil
 import pytest
-from pysigma import PySigma, parser
+from pysigma import PySigma, parser, signatures
 
 
 RULE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../rules'))
@@ -82,3 +83,59 @@ def test_check_logfile(sigma_parser):
                          'score': 'high',
                          'signature_source': None,
                          'title': 'System File Execution Location Anomaly'}
+
+
+def test_rule_cache(tmp_path):
+    rule_path = tmp_path / 'win_system_exe_anomaly.yml'
+    shutil.copy(os.path.join(RULE_DIR, 'win_system_exe_anomaly.yml'), rule_path)
+    cache_path = signatures.get_cache_path(rule_path)
+
+    sigma_parser = PySigma(rule_files=[rule_path], cache_rules=True)
+    assert cache_path.exists()
+    assert [rule.file_name for rule in sigma_parser.rules.values()] == [str(rule_path)]
+
+    # The JSON copy is loaded while it is newer than the rule
+    cache_path.write_text(cache_path.read_text().replace('Location Anomaly', 'Location Cached'))
+    os.utime(rule_path, (0, 0))
+    sigma_parser = PySigma(rule_files=[rule_path], cache_rules=True)
+    assert [rule.title for rule in sigma_parser.rules.values()] == ['System File Execution Location Cached']
+
+    # But not when the rule may have been edited in the same tick as the copy was written
+    os.utime(cache_path, (0, 0))
+    sigma_parser = PySigma(rule_files=[rule_path], cache_rules=True)
+    assert [rule.title for rule in sigma_parser.rules.values()] == ['System File Execution Location Anomaly']
+    cache_path.write_text(cache_path.read_text().replace('Location Anomaly', 'Location Cached'))
+    os.utime(rule_path, (0, 0))
+
+    # And replaced once the rule is edited
+    os.utime(cache_path, (0, 0))
+    os.utime(rule_path)
+    sigma_parser = PySigma(rule_files=[rule_path], cache_rules=True)
+    assert [rule.title for rule in sigma_parser.rules.values()] == ['System File Execution Location Anomaly']
+    assert 'Location Anomaly' in cache_path.read_text()
+
+
+def test_add_signatures(sigma_parser):
+    parallel_parser = PySigma()
+    parallel_parser.add_signatures([os.path.join(RULE_DIR, rule) for rule in os.listdir(RULE_DIR)], max_workers=2)
+    assert parallel_parser.rules.keys() == sigma_parser.rules.keys()
+
+    events = parallel_parser.build_sysmon_events(logfile_path)
+    assert parallel_parser.check_events(events) == sigma_parser.check_events(events)
+
+
+def test_check_logfile_batch(sigma_parser):
+    events = sigma_parser.build_sysmon_events(logfile_path)
+    assert sigma_parser.check_events_batch(events) == sigma_parser.check_events(events)
+
+
+def test_check_with_rules_small_rule_dir(sigma_parser, monkeypatch):
+    import pysigma.pysigma as pysigma_cli
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError('a worker pool was started for a handful of rules')
+
+    monkeypatch.setattr(pysigma_cli, 'ProcessPoolExecutor', no_pool)
+    scoreboard = pysigma_cli.check_with_rules([logfile_path], RULE_DIR)
+    sigma_parser.check_logfile(logfile_path)
+    assert {_id for _ids in scoreboard[logfile_path].values() for _id in _ids} == set(sigma_parser.hits)